@@ -83,16 +83,26 @@
 
 import os
 import re
+import mmap
 import time
 import shutil
 import openpyxl
 import logging
 from datetime import datetime
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
 from logcreator import setup_logging, logged_input, logged_print
 from openpyxl.styles import Font, Color, Alignment, NamedStyle
 from openpyxl import Workbook
 from openpyxl import load_workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.drawing.image import Image
+from openpyxl.utils import get_column_letter
+# xlsxwriter writes the sheet XML directly and is used when installed, otherwise openpyxl write-only mode
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
 
 class GaussianLogAnalyzer:
     def __init__(self):
@@ -105,25 +115,38 @@ class GaussianLogAnalyzer:
         self.count_all = 0
         self.analysis_type = None
         self.save_type = None
+        # Patterns are compiled once here and reused for every log file.
+        # They are bytes patterns, logs are scanned as raw bytes straight from an mmap
         self.opt_patterns = {
-            "sym" : r'P\s*G\s*=\s*([^=\[]*)\s*\[',
+            "sym" : re.compile(rb'P\s*G\s*=\s*(?P<sym>[^=\[]*)\s*\['),
             #"state": r'S[\n\s]*t[\n\s]*a[\n\s]*t[\n\s]*e[\n\s]*=[\n\s]*([^=\\]*)[\n\s]*\\',
-            "state": r'S\s*t\s*a\s*t\s*e\s*=\s*([^=\\]*)\s*\\',
+            "state": re.compile(rb'S\s*t\s*a\s*t\s*e\s*=\s*(?P<state>[^=\\]*)\s*\\'),
             #"hf": r'H[\n\s]*F[\n\s]*=[\n\s]*([^=\\]*)[\n\s]*\\',
-            "hf": r'H\s*F\s*=\s*([^=\\]*)\s*\\',
-            "zpe" : r'Zero-point correction=\s*([^=\(]*)\s*\(',
-            "etot" : r'Sum of electronic and zero-point Energies=\s*([^=\s]*)\n',
+            "hf": re.compile(rb'H\s*F\s*=\s*(?P<hf>[^=\\]*)\s*\\'),
+            "zpe" : re.compile(rb'Zero-point correction=\s*(?P<zpe>[^=\(]*)\s*\('),
+            "etot" : re.compile(rb'Sum of electronic and zero-point Energies=\s*(?P<etot>[^=\s]*)\r?\n'),
             #"nimag" : r'N\n*\s*I\n*\s*m\n*\s*a\n*\s*g\n*\s*=\n*\s*([^=\\]*)\\'
-            "nimag" : r'N\s*I\s*m\s*a\s*g\s*=\s*([^=\\]*)\\'
+            "nimag" : re.compile(rb'N\s*I\s*m\s*a\s*g\s*=\s*(?P<nimag>[^=\\]*)\\')
         }
         self.sp_patterns = {
             #"sym" : r'P[\n\s]*G[\n\s]=[\n\s]*([^=[]*)[\n\s]*\[',
-            "sym" : r'P\s*G\s*=\s*([^=[]*)\s*\[',
+            "sym" : re.compile(rb'P\s*G\s*=\s*(?P<sym>[^=[]*)\s*\['),
             #"state" : r'S[\n\s]*t[\n\s]*a[\n\s]*t[\n\s]*e[\n\s]*=[\n\s]*([^=\\]*)[\n\s]*\\',
-            "state" : r'S\s*t\s*a\s*t\s*e\s*=\s*([^=\\]*)\s*\\',
+            "state" : re.compile(rb'S\s*t\s*a\s*t\s*e\s*=\s*(?P<state>[^=\\]*)\s*\\'),
             #"hf" : r'H[\n\s]*F[\n\s]*=[\n\s]*([^=\\]*)[\n\s]*\\'
-            "hf" : r'H\s*F\s*=\s*([^=\\]*)\s*\\'
+            "hf" : re.compile(rb'H\s*F\s*=\s*(?P<hf>[^=\\]*)\s*\\')
         }
+        # One alternation per log region, so each region is scanned a single time.
+        # sym, state, hf and nimag live in the archive block (1\1\...) at the end of the log,
+        # zpe and etot in the thermochemistry section printed before it.
+        self.archive_marker = b'1\\1\\'
+        self.thermo_marker = b'Zero-point correction='
+        self.opt_archive_regex = re.compile(b'|'.join(self.opt_patterns[key].pattern for key in ("sym", "state", "hf", "nimag")))
+        self.opt_thermo_regex = re.compile(b'|'.join(self.opt_patterns[key].pattern for key in ("zpe", "etot")))
+        self.sp_regex = re.compile(b'|'.join(pattern.pattern for pattern in self.sp_patterns.values()))
+        self.error_pattern = re.compile(rb'/g16/(.+?)\.exe')
+        # Archive values may be wrapped over lines, all whitespace is deleted from a capture in one pass
+        self.whitespace = b' \t\r\n'
         self.sym_patterns = {
             "C01" : "C1",
             "C02" : "C2",
@@ -387,21 +410,12 @@ class GaussianLogAnalyzer:
         logged_print("Analysing OPT logs, please wait.....")
         start_time = time.time()
         log_path = os.path.abspath(self.log_dir)
-        log_files = [os.path.join(root, file) for root, dirs, files in os.walk(log_path) for file in files if file.endswith('.log')]
+        log_files = list(self._iter_logs(log_path))
         # update total number of files
         self.count_all = len(log_files)
-        # open created excel file 
-        wb = openpyxl.load_workbook(self.excel_save_path)
-        sheet = wb.active if wb.active else wb.create_sheet()
-        sheet.append(["","Cluster","Init Struct.","Opted Struct.", "Sym.", "State", "HF", "ZPE", "Etot", "△E", "NImag"])
-        for log_file in log_files:
-            with open(log_file, 'r', encoding='utf-8') as file:
-                log_content = file.read()
-                data_row = self._process_opt_data(log_content, os.path.basename(log_file))
-            sheet.append(data_row)
-        self._finalize_opt_excel_sheet(sheet)
-        wb.save(self.excel_save_path)
-        wb.close()
+        # Rows are streamed into a new workbook, which replaces the created placeholder file
+        header = ["","Cluster","Init Struct.","Opted Struct.", "Sym.", "State", "HF", "ZPE", "Etot", "△E", "NImag"]
+        self._finalize_opt_excel_sheet(header, self._analyze_logs(log_files))
         end_time = time.time()
         logged_print("OPT log analysis complete!")
         logged_print(f"Successfully analyzed {self.count_all} .log files, Normal termination: {self.count_successed}, Error termination: {self.count_failed}.")
@@ -412,16 +426,13 @@ class GaussianLogAnalyzer:
         logged_print("Analyzing .log files, please wait.....")
         start_time = time.time()
         log_path = os.path.abspath(self.log_dir)
-        log_files = [os.path.join(root, file) for root, dirs, files in os.walk(log_path) for file in files if file.endswith('.log')]
+        log_files = list(self._iter_logs(log_path))
         self.count_all = len(log_files)
+        # Ensure that data_row is a string type
+        lines = [' '.join([str(item) for item in data_row if item != ""]) for data_row in self._analyze_logs(log_files)]
         with open(self.txt_save_path, 'w', encoding='utf-8') as f:
-            for log_file in log_files:
-                with open(log_file, 'r', encoding='utf-8') as file:
-                    log_content = file.read()
-                    data_row = self._process_opt_data(log_content, os.path.basename(log_file))
-                    # Ensure that data_row is a string type
-                    data_row_str = ' '.join([str(item) for item in data_row if item != ""])
-                    f.write(data_row_str + "\n")  # Write each line of data to the file and add a newline character
+            # Write the whole file at once, every line of data ends with a newline character
+            f.write(''.join(line + "\n" for line in lines))
         end_time = time.time()  # end timing
         logged_print(f"Successfully analyzed {self.count_all} .log files, Normal termination: {self.count_successed}, Error termination: {self.count_failed}.")
         logged_print(f"Results are saved in {self.txt_save_path}")
@@ -431,20 +442,10 @@ class GaussianLogAnalyzer:
         logged_print("Analysing SP job files, please wait.....")
         start_time = time.time()
         log_path = os.path.abspath(self.log_dir)
-        log_files = [os.path.join(root, file) for root, dirs, files in os.walk(log_path) for file in files if file.endswith('.log')]
+        log_files = list(self._iter_logs(log_path))
         self.count_all = len(log_files)
-        wb = openpyxl.load_workbook(self.excel_save_path)
-        sheet = wb.active if wb.active else wb.create_sheet()
-        sheet.append(["","Cluster","Struct", "Sym.", "State", "HF", "△E"])
-        
-        for log_file in log_files:
-            with open(log_file, 'r', encoding='utf-8') as file:
-                log_content = file.read()
-                data_row = self._process_sp_data(log_content, os.path.basename(log_file))
-            sheet.append(data_row)
-        self._finalize_sp_excel_sheet(sheet)
-        wb.save(self.excel_save_path)
-        wb.close()
+        header = ["","Cluster","Struct", "Sym.", "State", "HF", "△E"]
+        self._finalize_sp_excel_sheet(header, self._analyze_logs(log_files))
         end_time = time.time()
         logged_print("SP job analysis complete!")
         logged_print(f"Successfully analyzed {self.count_all} .log files, Normal termination: {self.count_successed}, Error termination: {self.count_failed}.")
@@ -455,251 +456,249 @@ class GaussianLogAnalyzer:
         logged_print("Analyzing .log files, please wait.....")
         start_time = time.time()
         log_path = os.path.abspath(self.log_dir)
-        log_files = [os.path.join(root, file) for root, dirs, files in os.walk(log_path) for file in files if file.endswith('.log')]
+        log_files = list(self._iter_logs(log_path))
         self.count_all = len(log_files)
+        lines = [' '.join([str(item) for item in data_row if item != ""]) for data_row in self._analyze_logs(log_files)]
         with open(self.txt_save_path, 'w', encoding='utf-8') as f:
-            for log_file in log_files:
-                with open(log_file, 'r', encoding='utf-8') as file:
-                    log_content = file.read()
-                    data_row = self._process_sp_data(log_content, os.path.basename(log_file))
-                    data_row_str = ' '.join([str(item) for item in data_row if item != ""])
-                    f.write(data_row_str + "\n")
+            f.write(''.join(line + "\n" for line in lines))
         end_time = time.time()
         logged_print(f"Successfully analyzed {self.count_all} .log files, Normal termination: {self.count_successed}, Error termination: {self.count_failed}.")
         logged_print(f"Results are saved in {self.txt_save_path}")
         logged_print(f"Analysis completed in {end_time - start_time} seconds")
 
-    def _process_opt_data(self, log_content, file_name):
-        start_time = time.time()
-        data_row = []
-        data_row.append("")
-        data_row.append(file_name)
-        if "Normal termination of Gaussian" not in log_content:
-            error_matches = re.findall(r'/g16/(.+?)\.exe', log_content)
-            if error_matches:
-                # Add three empty elements first, then append error information
-                data_row.extend(["", "", "", error_matches[-1]])
-                self.count_failed += 1
-            else: 
-                data_row.extend(["", "", "", "UnknownError"])
+    def _iter_logs(self, root):
+        # Same order as os.walk, but the DirEntry already knows its type, so no extra stat per entry
+        subdirs = []
+        try:
+            entries = os.scandir(root)
+        except OSError:
+            # os.walk skips unreadable folders as well
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file() and entry.name.endswith('.log'):
+                    yield entry.path
+        for subdir in subdirs:
+            yield from self._iter_logs(subdir)
+
+    def _analyze_logs(self, log_files):
+        """ Analyze log files in worker processes, rows are returned in the order of log_files """
+        with ProcessPoolExecutor() as executor:
+            chunksize = max(1, len(log_files) // ((os.cpu_count() or 1) * 4))
+            results = list(executor.map(self._analyze_log_file, log_files, chunksize=chunksize))
+        rows = []
+        for data_row, normal in results:
+            if normal:
+                self.count_successed += 1
+            else:
                 self.count_failed += 1
+            rows.append(data_row)
+        return rows
+
+    def _analyze_log_file(self, log_file):
+        # Runs in a worker process, so it must not touch the counters on self
+        process = self._process_opt_data if self.analysis_type == 'opt' else self._process_sp_data
+        file_name = os.path.basename(log_file)
+        with open(log_file, 'rb') as file:
+            # An empty file cannot be mapped
+            if os.fstat(file.fileno()).st_size == 0:
+                return process(b'', file_name)
+            # The regexes run on the mapped pages, only the captured values are decoded
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as log_content:
+                return process(log_content, file_name)
+
+    def _process_opt_data(self, log_content, file_name):
+        # One slot per header column: "", Cluster, Init Struct., Opted Struct., Sym., State, HF, ZPE, Etot, △E, NImag
+        data_row = [""] * 11
+        data_row[1] = file_name
+        normal = log_content.find(b"Normal termination of Gaussian") != -1
+        if not normal:
+            error_matches = self.error_pattern.findall(log_content)
+            # Error information goes to the State column
+            data_row[5] = error_matches[-1].decode() if error_matches else "UnknownError"
         else:
-            data_row.extend(["", ""])
-            for key in self.opt_patterns:
-                pattern = self.opt_patterns[key]
-                match = re.findall(pattern, log_content)
-                if key == 'sym':
-                    if match:
-                        content = match[-1].replace(' ', '').replace('\n', '').replace('\r', '')
-                        # Find and replace the value of 'sym'
-                        transformed_content = self.sym_patterns.get(content, content)   
-                        data_row.append(transformed_content)
-                    else:
-                        data_row.append("")  
-                elif key == 'state':
-                    # Find and replace the value of 'state'
-                    if match:
-                        content = match[-1].replace(' ', '').replace('\n', '').replace('\r', '')
-                        data_row.append(content)
-                    else:
-                        data_row.append("")
-                elif key == 'hf':
-                    # Find and replace the value of 'hf'
-                    if match:
-                        content = float(match[-1].replace(" ", "").replace("\n", ""))
-                        data_row.append(content)
-                    else:
-                        data_row.append("")
-                elif key == 'zpe':
-                    # Find and replace the value of 'zpe'
-                    if match:
-                        content = float(match[-1])
-                        data_row.append(content)
-                    else:
-                        data_row.append("")
-                elif key == 'etot':
-                    # Find and replace the value of 'etot'
-                    if match:
-                        content = float(match[-1])
-                        data_row.append(content)
-                    else:
-                        data_row.append("")
-                elif key == 'nimag':
-                    data_row.append("")
-                    # Find and replace the value of 'nimag'
-                    if match:
-                        content = float(match[-1].replace(' ', '').replace('\n', '').replace('\r', ''))
-                        data_row.append(content)
-                    else:
-                        data_row.append("")
-                else:
-                    #  Handle other unspecified keys
-                    data_row.append("")
-        end_time = time.time()
-        #print(f"re spend {end_time - start_time} seconds")
-        return data_row
+            # Only the last archive block is searched; without one, fall back to the whole log
+            archive_start = max(log_content.rfind(self.archive_marker), 0)
+            thermo_end = archive_start or len(log_content)
+            # Keep the last hit of every key, the same as findall(...)[-1]
+            matches = {}
+            whitespace = self.whitespace
+            # zpe and etot are printed together, so the thermo scan starts at the last zpe line
+            # and is skipped entirely for logs without a frequency job
+            thermo_start = log_content.rfind(self.thermo_marker, 0, thermo_end)
+            if thermo_start != -1:
+                for m in self.opt_thermo_regex.finditer(log_content, thermo_start, thermo_end):
+                    matches[m.lastgroup] = m.group(m.lastgroup).translate(None, whitespace).decode()
+            for m in self.opt_archive_regex.finditer(log_content, archive_start):
+                matches[m.lastgroup] = m.group(m.lastgroup).translate(None, whitespace).decode()
+            sym = matches.get("sym")
+            if sym:
+                # Find and replace the value of 'sym'
+                data_row[4] = self.sym_patterns.get(sym, sym)
+            if matches.get("state"):
+                data_row[5] = matches["state"]
+            # The numeric values, △E (column 9) is filled in after sorting
+            for key, column_index in (("hf", 6), ("zpe", 7), ("etot", 8), ("nimag", 10)):
+                if matches.get(key):
+                    data_row[column_index] = float(matches[key])
+        return data_row, normal
 
     def _process_sp_data(self, log_content, file_name):
-        start_time = time.time()
-        data_row = []
-        data_row.append("")
-        data_row.append(file_name)
-        if "Normal termination of Gaussian" not in log_content:
-            error_matches = re.findall(r'/g16/(.+?)\.exe', log_content)
-            if error_matches:
-                data_row.extend(["", "", error_matches[-1]])
-                self.count_failed += 1
-            else: 
-                data_row.extend(["", "", "UnknownError"])
-                self.count_failed += 1
+        # One slot per header column: "", Cluster, Struct, Sym., State, HF, △E
+        data_row = [""] * 7
+        data_row[1] = file_name
+        normal = log_content.find(b"Normal termination of Gaussian") != -1
+        if not normal:
+            error_matches = self.error_pattern.findall(log_content)
+            data_row[4] = error_matches[-1].decode() if error_matches else "UnknownError"
         else:
-            data_row.extend([""])
-            for key in self.sp_patterns:
-                pattern = self.opt_patterns[key]
-                match = re.findall(pattern, log_content)
-                if key == 'sym':
-                    if match:
-                        content = match[-1].replace(' ', '').replace('\n', '').replace('\r', '')
-                        transformed_content = self.sym_patterns.get(content, content)
-                        data_row.append(transformed_content)
-                    else:
-                        data_row.append("")
-                elif key == 'state':
-                    if match:
-                        content = match[-1].replace(' ', '').replace('\n', '').replace('\r', '')
-                        data_row.append(content)
-                    else:
-                        data_row.append("")
-                elif key == 'hf':
-                    if match:
-                        content = float(match[-1].replace(" ", "").replace("\n", ""))
-                        data_row.append(content)
-                    else:
-                        data_row.append("")
-                else:
-                    data_row.append("UnknownError")
-        end_time = time.time()
-        #print(f"re spend {end_time - start_time} seconds")
+            archive_start = max(log_content.rfind(self.archive_marker), 0)
+            matches = {}
+            whitespace = self.whitespace
+            for m in self.sp_regex.finditer(log_content, archive_start):
+                matches[m.lastgroup] = m.group(m.lastgroup).translate(None, whitespace).decode()
+            sym = matches.get("sym")
+            if sym:
+                data_row[3] = self.sym_patterns.get(sym, sym)
+            if matches.get("state"):
+                data_row[4] = matches["state"]
+            if matches.get("hf"):
+                data_row[5] = float(matches["hf"])
         #print(data_row[0:])
-        return data_row
+        return data_row, normal
 
     # New private method: complete the final adjustment of the Excel spreadsheet for opt tasks
-    def _finalize_opt_excel_sheet(self, sheet):
+    # A streamed sheet cannot be edited after writing, so rows are sorted and finished as lists first
+    def _finalize_opt_excel_sheet(self, header, rows):
         start_time = time.time()
 
-        self.set_sheet_format(sheet)
-        self.sort_by_etot(sheet)
-        self.cal_opt_diff(sheet)
+        # Sort the rows by Etot in ascending order
+        self.sort_by_column(rows, 9)
+        self.cal_opt_diff(rows)
+        self.save_excel(header, rows)
         
         end_time = time.time()
         execution_time = end_time - start_time
         logged_print(f"Finalizing Excel sheet completed in {execution_time} seconds")
 
     # New private method: complete the final adjustment of the Excel spreadsheet for sp tasks
-    def _finalize_sp_excel_sheet(self, sheet):
+    def _finalize_sp_excel_sheet(self, header, rows):
         start_time = time.time()
-        self.set_sheet_format(sheet)
-        self.sort_by_hf(sheet)
-        self.cal_sp_diff(sheet)
+        # Same as opt tasks but by HF
+        self.sort_by_column(rows, 6)
+        self.cal_sp_diff(rows)
+        self.save_excel(header, rows)
         end_time = time.time()
         execution_time = end_time - start_time
         logged_print(f"Finalizing Excel sheet completed in {execution_time} seconds")
 
-    def set_sheet_format(self, sheet):
-        # Automatically adjust column widths
-        for column_cells in sheet.columns:
-            length = max(len(str(cell.value)) for cell in column_cells)
-            header_length = len(str(column_cells[0].value))#Get the length of the content of the title row
+    def save_excel(self, header, rows):
+        widths = self.column_widths(header, rows)
+        if xlsxwriter is not None:
+            self.save_excel_xlsxwriter(header, rows, widths)
+        else:
+            wb = Workbook(write_only=True)
+            sheet = wb.create_sheet()
+            self.set_sheet_format(sheet, widths)
+            self.write_sheet_rows(sheet, header, rows)
+            wb.save(self.excel_save_path)
+            wb.close()
+
+    def save_excel_xlsxwriter(self, header, rows, widths):
+        # constant_memory flushes every row to the sheet XML as soon as it is written
+        workbook = xlsxwriter.Workbook(self.excel_save_path, {'constant_memory': True})
+        worksheet = workbook.add_worksheet('Sheet')
+        sheet_format = workbook.add_format({'font_name': 'Times New Roman', 'font_size': 13, 'align': 'center', 'valign': 'vcenter'})
+        title_format = workbook.add_format({'font_name': 'Times New Roman', 'font_size': 15, 'bold': True, 'align': 'center', 'valign': 'vcenter'})
+        for column_index, width in enumerate(widths):
+            worksheet.set_column(column_index, column_index, width)
+        worksheet.set_row(0, 25)
+        worksheet.write_row(0, 0, header, title_format)
+        for row_index, row in enumerate(rows, start=1):
+            worksheet.write_row(row_index, 0, row, sheet_format)
+        workbook.close()
+
+    def column_widths(self, header, rows):
+        # Automatically adjust column widths from the values, before any row is written
+        widths = []
+        for column_index, title in enumerate(header):
+            length = max((len(str(row[column_index])) for row in rows), default=0)
+            header_length = len(str(title))#Get the length of the content of the title row
             length = max(length, header_length)  #Compare the length of the content of the title row with the length of the data rows, and take the larger value
-            sheet.column_dimensions[column_cells[0].column_letter].width = length + 6
-        # Create font and alignment styles
+            widths.append(length + 6)
+        return widths
+
+    def set_sheet_format(self, sheet, widths):
+        # Column widths must be set before any row is written to a write-only sheet
+        for column_index, width in enumerate(widths):
+            sheet.column_dimensions[get_column_letter(column_index + 1)].width = width
+        sheet.row_dimensions[1].height = 25
+
+    def write_sheet_rows(self, sheet, header, rows):
+        # Create font and alignment styles, shared by all the cells
         sheet_font = Font(name='Times New Roman', size=13)
         sheet_alignment = Alignment(horizontal='center', vertical='center')
         title_font = Font(name='Times New Roman', size=15, bold=True)
         title_alignment = Alignment(horizontal='center', vertical='center')
-        # Apply styles to all cells
-        for row in sheet.iter_rows(min_row=2):
-            for cell in row:
-                cell.font = sheet_font
-                cell.alignment = sheet_alignment
         # Apply title styles
-        for cell in sheet[1]:
+        title_row = []
+        for value in header:
+            cell = WriteOnlyCell(sheet, value=value)
             cell.font = title_font
             cell.alignment = title_alignment
-        sheet.row_dimensions[1].height = 25
+            title_row.append(cell)
+        sheet.append(title_row)
+        # Apply styles to all cells
+        for row in rows:
+            cells = []
+            for value in row:
+                cell = WriteOnlyCell(sheet, value=value)
+                cell.font = sheet_font
+                cell.alignment = sheet_alignment
+                cells.append(cell)
+            sheet.append(cells)
         
-    # Sort the Etot rows in ascending order
-    def sort_by_etot(self, sheet, column_index=9, descending=False):
-        # Extract all the row data from the worksheet, ignoring the header row (first row)
-        rows = list(sheet.iter_rows(values_only=True))
-        headers, data_rows = rows[0], rows[1:]
-        # Define a sort key function
-        def sort_key(row):
-            # get the value of the key
-            value = row[column_index-1]
-            # If the value is numeric, return the value; otherwise, return infinity or negative infinity depending on sort direction
-            return value if isinstance(value, (int, float)) else float('inf') if not descending else float('-inf')
-        # Sort all rows based on values in the specified column using the defined sort key function
-        data_rows.sort(key=sort_key, reverse=descending)
-        # Clear the worksheet (except for the header row)
-        for row in sheet.iter_rows(min_row=2):
-            for cell in row:
-                cell.value = None
-        # Write the sorted data back into the worksheet (starting from the second row because the first row is the header row)
-        for row_idx, row_data in enumerate(data_rows, start=2):
-            for col_idx, value in enumerate(row_data, start=1):
-                sheet.cell(row=row_idx, column=col_idx, value=value)
-
-    # Same as the previous sorting method but for the HF column
-    def sort_by_hf(self, sheet, column_index=6, descending=False):
-        rows = list(sheet.iter_rows(values_only=True))
-        headers, data_rows = rows[0], rows[1:]
-        def sort_key(row):
-            value = row[column_index-1]
-            return value if isinstance(value, (int, float)) else float('inf') if not descending else float('-inf')
-        data_rows.sort(key=sort_key, reverse=descending)
-        for row in sheet.iter_rows(min_row=2):
-            for cell in row:
-                cell.value = None
-        for row_idx, row_data in enumerate(data_rows, start=2):
-            for col_idx, value in enumerate(row_data, start=1):
-                sheet.cell(row=row_idx, column=col_idx, value=value)
-
-    def cal_opt_diff(self, sheet):
-        base_value_cell = 'I2'
-        multiplier = 27.21138
-        column_index = 10  
-        for row_idx in range(2, sheet.max_row + 1):
-            # Now that column_index is defined, it can be safely used
-            diff_cell = sheet.cell(row=row_idx, column = column_index)
-            current_value_cell = f'I{row_idx}'
-            # Calculate the difference between the current row and the base row and multiply by a constant for the opt tasks
-            diff_cell.value = (
-                f"=IF(AND(ISNUMBER({current_value_cell}), {current_value_cell}<>0, "
-                f"ISNUMBER({base_value_cell}), {base_value_cell}<>0), "
-                f"({current_value_cell}-{base_value_cell})*{multiplier}, \"\")"
-                                )
-
-    def cal_sp_diff(self, sheet):
-       base_value_cell = 'F2'
-       multiplier = 27.21138
-       column_index = 7
-       for row_idx in range(2, sheet.max_row + 1):
-           diff_cell = sheet.cell(row=row_idx, column = column_index)
-           current_value_cell = f'F{row_idx}'
-           diff_cell.value = (
-               f"=IF(AND(ISNUMBER({current_value_cell}), {current_value_cell}<>0, "
-               f"ISNUMBER({base_value_cell}), {base_value_cell}<>0), "
-               f"({current_value_cell}-{base_value_cell})*{multiplier}, \"\")"
-                                )
+    # Sort the rows by the values in one column, column_index counts from 1 as in the sheet
+    def sort_by_column(self, data_rows, column_index, descending=False):
+        # Non-numeric values get infinity or negative infinity depending on sort direction, so they end up last
+        sentinel = float('inf') if not descending else float('-inf')
+        # The keys are normalized once, then the sort runs on itemgetter without any Python callback
+        keyed_rows = [(value if isinstance(value, (int, float)) else sentinel, row)
+                      for value, row in zip(map(itemgetter(column_index-1), data_rows), data_rows)]
+        keyed_rows.sort(key=itemgetter(0), reverse=descending)
+        data_rows[:] = map(itemgetter(1), keyed_rows)
+
+    # The difference to the lowest row is computed here instead of writing an Excel formula per row
+    def cal_diff(self, data_rows, value_index, diff_index, multiplier=27.21138):
+        base_value = data_rows[0][value_index] if data_rows else None
+        base_valid = isinstance(base_value, float) and base_value != 0
+        for row in data_rows:
+            value = row[value_index]
+            # Same rule as the former formula: only non-zero numbers on both sides get a value
+            if base_valid and isinstance(value, float) and value != 0:
+                row[diff_index] = (value - base_value) * multiplier
+            else:
+                row[diff_index] = ""
+
+    def cal_opt_diff(self, data_rows):
+        # Etot is column I, △E column J, difference in eV
+        self.cal_diff(data_rows, 8, 9)
+
+    def cal_sp_diff(self, data_rows):
+        # HF is column F, △E column G
+        self.cal_diff(data_rows, 5, 6)
 
     def run(self):
         start_time = datetime.now()
+        start_counter = time.perf_counter()
         logging.info(f"Func 1 started at {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
         self.start_analysis()
         end_time = datetime.now()
         logging.info(f"Func 1 ended at{end_time.strftime('%Y-%m-%d %H:%M:%S')}")
-        duration_seconds = int((end_time - start_time).total_seconds())
+        # The duration comes from the monotonic counter, the wall clock is only used for the log stamps
+        duration_seconds = int(time.perf_counter() - start_counter)
         minutes, seconds = divmod(duration_seconds, 60)
         logging.info(f"Total duration: {minutes} minutes {seconds} seconds")
 
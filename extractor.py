@@ -5,14 +5,19 @@
     Last Update: 2024-04-01
 '''
 
+import io
 import os
 import re
+import mmap
 import time
+import json
+import hashlib
 import pymol
 import shutil
 import openpyxl
 import logging
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from logcreator import logged_input, logged_print
 from pymol import cmd
 from pymol import chempy
@@ -20,6 +25,14 @@ from openpyxl.styles import Font, Color, Alignment, NamedStyle
 from openpyxl import Workbook
 from openpyxl import load_workbook
 from openpyxl.drawing.image import Image
+from PIL import Image as PILImage
+import numpy as np
+# RDKit is optional, with CHEMAUTO_FAST_RENDER=1 it draws the images instead of PyMOL
+try:
+    from rdkit import Chem
+    from rdkit.Chem import Draw, rdDetermineBonds
+except ImportError:
+    Chem = None
 
 class StructExtractor():
     def __init__(self):
@@ -35,13 +48,20 @@ class StructExtractor():
                     91: 'Pa', 92: 'U', 93: 'Np', 94: 'Pu', 95: 'Am', 96: 'Cm', 97: 'Bk', 98: 'Cf', 99: 'Es', 100: 'Fm', 
                     101: 'Md', 102: 'No', 103: 'Lr', 104: 'Rf', 105: 'Db', 106: 'Sg', 107: 'Bh', 108: 'Hs', 109: 'Mt', 
                     110: 'Ds', 111: 'Rg', 112: 'Cn', 113: 'Nh', 114: 'Fl', 115: 'Mc', 116: 'Lv', 117: 'Ts', 118: 'Og'}
-        self.lines = []
-        self.atom_num = 0
-        self.coord_start_indices = []
+        # The same symbols indexed by atomic number (index 0 unused), a whole block is looked up by fancy indexing
+        self.elementArr = np.array([''] + [self.elementDict[z] for z in range(1, 119)])
+        self.natoms_regex = re.compile(rb'NAtoms=\s*(\d+)')
+        self.orientation_marker = b'Standard orientation:'
         self.num_struct = 50
         self.excel_file_path = None
         self.base_path = None
         self.extract_type = None
+        # The images show up about 120 px wide in the sheet, they are rendered at twice that size for antialiasing
+        self.image_size = 240
+        # Parsed logs are cached per user, bump cache_version whenever the parse result changes
+        self.cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "chemauto", "logs")
+        self.cache_version = 2
+        self.cache_days = 30
 
     def handle_user_input(self):
         while True:
@@ -90,9 +110,14 @@ class StructExtractor():
                 return 'r'
             else:
                 logged_print("Invalid choice, please choose again!")
-        workbook = openpyxl.load_workbook(self.excel_file_path)
+        # Read-only mode takes max_row from the sheet dimension instead of parsing every cell
+        workbook = openpyxl.load_workbook(self.excel_file_path, read_only=True)
         sheet = workbook.active
+        if sheet.max_row is None:
+            # Unsized sheet without a dimension record
+            sheet.calculate_dimension(force=True)
         max_row = sheet.max_row
+        workbook.close()
 
         while True:
             num_structures = logged_input(f"\nPlease input the number of structures to extract (1-{max_row - 1})\n")
@@ -119,12 +144,16 @@ class StructExtractor():
             shutil.copy2(original_excel_path, new_excel_path)    
         except PermissionError:
             logged_print("The file is currently open. Please close the file and try again.")
-            return None, None
+            return None, None, None
+        # The copy is loaded once, the same workbook gets the images in insert_images_to_excel
         new_wb = load_workbook(new_excel_path)
         new_sheet = new_wb.active
+        # Only column B of the first rows is needed
+        cell_values = [row[0] for row in new_sheet.iter_rows(min_row=2, max_row=self.num_struct + 1, min_col=2, max_col=2, values_only=True)]
+        # Rows missing at the end of the sheet are kept as empty names
+        cell_values += [None] * (self.num_struct - len(cell_values))
         file_names = []
-        for i in range(2, self.num_struct + 2):
-            cell_value = new_sheet.cell(row=i, column=2).value
+        for cell_value in cell_values:
             if cell_value:
                 file_name = os.path.join(self.base_path, os.path.splitext(cell_value)[0])
             else:
@@ -132,134 +161,219 @@ class StructExtractor():
             file_names.append(file_name)
         #print(file_names[0:])
         logged_print("Excel file copied successfully.")
-        return new_excel_path, file_names
+        return new_excel_path, file_names, new_wb
         
     def generate_xyz(self, file_names):
         start_time = time.time()
         logged_print("\nGenerating xyz files, please wait....")
-        xyz_paths = []
+        # Find the log file of every folder first, "" keeps the row when there is none
+        log_files = []
         for folder_path in file_names:
-            if not folder_path:
-                xyz_paths.append({"opted": "", "init": ""})
-                continue
-            folder_name = os.path.basename(folder_path)
-            log_file_found = False
-            if os.path.isdir(folder_path):
-                for file in os.listdir(folder_path):
-                    if file.startswith(folder_name) and file.endswith('.log'):
-                        log_file_path = os.path.join(folder_path, file)
-                        
-                        if self.extract_type == 1:
-                            xyz_path_opted = self.extract_opted_structs(log_file_path)
-                            xyz_path_init = self.extract_init_structs(log_file_path)
-                            xyz_paths.append({"opted": xyz_path_opted, "init": xyz_path_init})
-                        elif self.extract_type == 2:
-                            xyz_path_opted = self.extract_opted_structs(log_file_path)
-                            xyz_paths.append({"opted": xyz_path_opted, "init": ""})
-                        log_file_found = True
-                        break  
-
-            if not log_file_found:
-                logged_print(f"No .log file found in folder: {folder_path}, skipping...")
-                xyz_paths.append({"opted": "", "init": ""})
-        
+            log_file_path = ""
+            if folder_path:
+                folder_name = os.path.basename(folder_path)
+                # Stop at the first matching entry, a missing folder or a file raises OSError
+                try:
+                    with os.scandir(folder_path) as entries:
+                        for entry in entries:
+                            if entry.name.startswith(folder_name) and entry.name.endswith('.log'):
+                                log_file_path = entry.path
+                                break
+                except OSError:
+                    pass
+                if not log_file_path:
+                    logged_print(f"No .log file found in folder: {folder_path}, skipping...")
+            log_files.append(log_file_path)
+
+        self._prune_log_cache()
+        # The save folders are created here, so the workers never race on makedirs
+        save_dirs = ["opted_structs"]
+        if self.extract_type == 1:
+            save_dirs.append("init_structs")
+        for parent_dir in {os.path.dirname(os.path.dirname(log_file)) for log_file in log_files if log_file}:
+            for save_dir in save_dirs:
+                os.makedirs(os.path.join(parent_dir, save_dir), exist_ok=True)
+
+        # Every log is independent, so they are parsed in worker processes, results keep the order of file_names
+        with ProcessPoolExecutor() as executor:
+            chunksize = max(1, len(log_files) // ((os.cpu_count() or 1) * 4))
+            results = list(executor.map(self._extract_log_structs, log_files, chunksize=chunksize))
+        # Worker processes have no log handler, their warnings are logged here
+        xyz_paths = []
+        for paths, messages in results:
+            for message in messages:
+                logged_print(message)
+            xyz_paths.append(paths)
+
         end_time = time.time()
         execution_time = end_time - start_time
         logged_print(f"Generate all xyz files in : {execution_time} seconds")
         return xyz_paths
 
-    def extract_init_structs(self, log_file):
-        self.line=[]
-        self.coord_start_indices=[]
-        current_path = os.path.dirname(log_file)
-        parent_dir = os.path.dirname(current_path)
-        xyz_save_path = os.path.join(parent_dir, "init_structs")
-        if not os.path.exists(xyz_save_path):
-            os.makedirs(xyz_save_path)
-        if log_file.endswith('.log'):
-            with open(log_file, 'r', encoding='utf-8') as f:
-                self.lines = f.readlines()
-            atom_found = False
-            for i, line in enumerate(self.lines):
-                if 'NAtoms=' in line and not atom_found:
-                    self.atom_num = int(line.split()[1])
-                    atom_found = True
-                if 'Standard orientation:' in line:
-                    self.coord_start_indices.append(i+5)
-        else:
-            raise ValueError(f"Invalid file: {log_file} or not a .log file")
+    def _extract_log_structs(self, log_file):
+        # Runs in a worker process, so the xyz paths and the warnings are returned instead of stored on self or logged
+        if not log_file:
+            return {"opted": "", "init": ""}, []
+        messages = []
+        xyz_paths = self.extract_structs(log_file, want_init=self.extract_type == 1, messages=messages)
+        return xyz_paths, messages
 
-        if len(self.coord_start_indices) == 0:
-            #No valid coordinate starting index found, returned error.
-            logged_print("UnknownError: No standard orientation found")
-            return ""
-        else:
-            coord_string = self.lines[self.coord_start_indices[0]:self.coord_start_indices[0]+self.atom_num]
-        extrCoord = ''
-        for item in coord_string:
+    def _parse_log(self, log_file):
+        """ Return the atom number and the coordinate lines of the first and the second last structure """
+        # Reruns on unchanged logs read the parse back from the cache folder
+        cache_file = self._log_cache(log_file)
+        parsed = self._read_log_cache(cache_file)
+        if parsed is None:
+            with open(log_file, 'rb') as f:
+                # An empty file cannot be mapped
+                if os.fstat(f.fileno()).st_size == 0:
+                    parsed = (0, None, None)
+                else:
+                    # The log is searched on the mapped pages, only the two blocks that are written out get decoded
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                        parsed = self._parse_log_content(content)
             try:
-                coord = [float(item.split()[3]), float(item.split()[4]), float(item.split()[5])]
-                atom_type = self.elementDict[int(item.split()[1])]
-                extrCoord += ' %-2s%27.8f%14.8f%14.8f\n' % (atom_type, coord[0], coord[1], coord[2])
-            except ValueError:
-                return "UnknownError: Invalid coordinate format"
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(cache_file, 'w', encoding='utf-8') as f:
+                    json.dump({"atom_num": parsed[0], "init": parsed[1], "opted": parsed[2]}, f)
+            except OSError:
+                pass
+        return parsed
 
-        xyz_file_path = os.path.join(xyz_save_path, os.path.splitext(os.path.basename(log_file))[0] + "-init.xyz")
-        with open(xyz_file_path, 'w', encoding='utf-8') as f:
-            f.write(str(self.atom_num) + "\n")  # number of atoms
-            f.write("\n")  # Comment line or empty line
-            f.write(extrCoord)  # Write the coordinate data
-        return xyz_file_path
+    def _log_cache(self, log_file):
+        # The key changes whenever the log is rewritten or the cache format changes, so a stale parse is never read
+        stat = os.stat(log_file)
+        key = f"{self.cache_version}|{os.path.abspath(log_file)}|{stat.st_mtime_ns}|{stat.st_size}".encode('utf-8')
+        return os.path.join(self.cache_dir, hashlib.blake2b(key, digest_size=16).hexdigest() + ".json")
 
-    def extract_opted_structs(self, log_file):
-        self.line=[]
-        self.coord_start_indices=[]
-        current_path = os.path.dirname(log_file)
-        parent_dir = os.path.dirname(current_path)
-        xyz_save_path = os.path.join(parent_dir, "opted_structs")
-        if not os.path.exists(xyz_save_path):
-            os.makedirs(xyz_save_path)
-        if log_file.endswith('.log'):
-            with open(log_file, 'r', encoding='utf-8') as f:
-                self.lines = f.readlines()
-            atom_found = False
-            for i, line in enumerate(self.lines):
-                if 'NAtoms=' in line and not atom_found:
-                    self.atom_num = int(line.split()[1])
-                    atom_found = True
-                if 'Standard orientation:' in line:
-                    self.coord_start_indices.append(i+5)
-        else:
+    @staticmethod
+    def _read_log_cache(cache_file):
+        # Anything that is not a complete cache entry is a miss, the log is parsed again
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            atom_num, init_block, opted_block = cached["atom_num"], cached["init"], cached["opted"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if type(atom_num) is not int:
+            return None
+        for block in (init_block, opted_block):
+            if block is not None and not (isinstance(block, list) and all(isinstance(line, str) for line in block)):
+                return None
+        return (atom_num, init_block, opted_block)
+
+    def _prune_log_cache(self):
+        # Entries older than cache_days are removed, including those of moved or rewritten logs
+        expire = time.time() - self.cache_days * 86400
+        try:
+            with os.scandir(self.cache_dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.name.endswith('.json') and entry.stat().st_mtime < expire:
+                            os.remove(entry.path)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+    def _parse_log_content(self, content):
+        atom_num = 0
+        pos = content.find(b'NAtoms=')
+        if pos != -1:
+            m = self.natoms_regex.match(content, pos)
+            if m:
+                atom_num = int(m.group(1))
+        coord_starts = []
+        pos = content.find(self.orientation_marker)
+        while pos != -1:
+            # The coordinates start 5 lines below the header
+            coord_starts.append(self._skip_lines(content, pos, 5))
+            pos = content.find(self.orientation_marker, pos + len(self.orientation_marker))
+        if not coord_starts:
+            return (atom_num, None, None)
+        init_block = self._coord_block(content, coord_starts[0], atom_num)
+        # Extracting the second last structure
+        opted_block = self._coord_block(content, coord_starts[-2], atom_num) if len(coord_starts) > 1 else init_block
+        return (atom_num, init_block, opted_block)
+
+    def _coord_block(self, content, start, atom_num):
+        return content[start:self._skip_lines(content, start, atom_num)].decode('utf-8').splitlines()
+
+    @staticmethod
+    def _skip_lines(content, offset, count):
+        # Offset of the line count lines below offset, or the end of content
+        for _ in range(count):
+            offset = content.find(b'\n', offset) + 1
+            if not offset:
+                return len(content)
+        return offset
+
+    def _format_coords(self, coord_lines):
+        """ Format the lines of a standard orientation table as xyz coordinate lines """
+        if not coord_lines:
+            return ''
+        # Atomic number and x, y, z columns, parsed in one call instead of four split() per line
+        coords = np.loadtxt(coord_lines, usecols=(1, 3, 4, 5), ndmin=2)
+        numbers = coords[:, 0].astype(int)
+        # Indexing does not check the range, 0 would give '' and a negative number would wrap to the end of the table
+        bad = (numbers != coords[:, 0]) | (numbers < 1) | (numbers >= len(self.elementArr))
+        if bad.any():
+            raise ValueError(f"Invalid atomic number {coords[bad, 0][0]:g} in the coordinates")
+        rows = np.empty((len(coords), 4), dtype=object)
+        rows[:, 0] = self.elementArr[numbers]
+        rows[:, 1:] = coords[:, 1:]
+        # One format call for the whole block
+        return (' %-2s%27.8f%14.8f%14.8f\n' * len(rows)) % tuple(rows.ravel())
+
+    def extract_structs(self, log_file, want_init=True, want_opted=True, messages=None):
+        """ Write the initial and/or the optimized structure of a log as xyz files, return {"opted": path, "init": path}.
+            Warnings are appended to messages when it is given, otherwise they are logged """
+        if not log_file.endswith('.log'):
             raise ValueError(f"Invalid file: {log_file} or not a .log file")
-        last_struct_index = len(self.coord_start_indices) - 1
-        if len(self.coord_start_indices) == 0:
-            logged_print("UnknownError: No standard orientation found")
-            return ""
-        if len(self.coord_start_indices) == 1:
-            coord_string = self.lines[self.coord_start_indices[0]:self.coord_start_indices[0]+self.atom_num]
-        else:
-            # Extracting the second last structure
-            coord_string = self.lines[self.coord_start_indices[last_struct_index - 1]:self.coord_start_indices[last_struct_index - 1]+self.atom_num]
-            
-        extrCoord = ''
-        for item in coord_string:
+        # Both structures come from a single parse of the log
+        atom_num, init_block, opted_block = self._parse_log(log_file)
+        parent_dir = os.path.dirname(os.path.dirname(log_file))
+        base_name = os.path.splitext(os.path.basename(log_file))[0]
+        xyz_paths = {"opted": "", "init": ""}
+        blocks = []
+        if want_opted:
+            blocks.append(("opted", opted_block))
+        if want_init:
+            blocks.append(("init", init_block))
+        for key, coord_string in blocks:
+            if coord_string is None:
+                #No valid coordinate starting index found, returned error.
+                message = "UnknownError: No standard orientation found"
+                if messages is None:
+                    logged_print(message)
+                else:
+                    messages.append(message)
+                continue
             try:
-                coord = [float(item.split()[3]), float(item.split()[4]), float(item.split()[5])]
-                atom_type = self.elementDict[int(item.split()[1])]
-                extrCoord += ' %-2s%27.8f%14.8f%14.8f\n' % (atom_type, coord[0], coord[1], coord[2])
+                extrCoord = self._format_coords(coord_string)
             except ValueError:
-                return "UnknownError: Invalid coordinate format"
+                xyz_paths[key] = "UnknownError: Invalid coordinate format"
+                continue
+            xyz_save_path = os.path.join(parent_dir, f"{key}_structs")
+            # Also needed when the wrappers are called outside generate_xyz
+            os.makedirs(xyz_save_path, exist_ok=True)
+            xyz_file_path = os.path.join(xyz_save_path, f"{base_name}-{key}.xyz")
+            # Number of atoms, an empty comment line and the coordinate data, written in one binary call
+            with open(xyz_file_path, 'wb') as f:
+                f.write(f"{atom_num}\n\n{extrCoord}".encode('utf-8'))
+            xyz_paths[key] = xyz_file_path
+        return xyz_paths
 
-        xyz_file_path = os.path.join(xyz_save_path, os.path.splitext(os.path.basename(log_file))[0] + "-opted.xyz")
-        with open(xyz_file_path, 'w', encoding='utf-8') as f:
-            f.write(str(self.atom_num) + "\n")  # number of atoms
-            f.write("\n")  # Comment line or empty line
-            f.write(extrCoord)  # Write the coordinate data
-        return xyz_file_path
+    def extract_init_structs(self, log_file):
+        return self.extract_structs(log_file, want_opted=False)["init"]
+
+    def extract_opted_structs(self, log_file):
+        return self.extract_structs(log_file, want_init=False)["opted"]
 
     def process_xyz_files(self, xyz_paths):
         start_time = time.time()
         logged_print("\nStart rendering please wait.....")
+        render_jobs = []
         for path_dict in xyz_paths:
             opted_path = path_dict.get("opted", "")
             init_path = path_dict.get("init", "")
@@ -269,92 +383,136 @@ class StructExtractor():
                 if not opted_path:
                     logged_print(f"Skipping opted xyz path: {opted_path}")
                 else:
-                    image_path = opted_path.replace(".xyz", ".png")
-                    self.render_from_xyz(opted_path, image_path)
+                    render_jobs.append((opted_path, opted_path.replace(".xyz", ".png")))
                 
                 if not init_path:
                     #print(f"Skipping init xyz path: {init_path}")
                     pass
                 else:
-                    image_path = init_path.replace(".xyz", ".png")
-                    self.render_from_xyz(init_path, image_path)
-            
+                    render_jobs.append((init_path, init_path.replace(".xyz", ".png")))
+
+        fast_render = os.environ.get("CHEMAUTO_FAST_RENDER") == "1"
+        if fast_render and Chem is None:
+            logged_print("RDKit is not installed, rendering with PyMOL.")
+            fast_render = False
+        if render_jobs and fast_render:
+            cpu_count = os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=min(len(render_jobs), cpu_count)) as executor:
+                # A failed xyz only loses its image and becomes an UnknownError cell, the warning is logged here
+                for message in executor.map(self.render_from_xyz_rdkit, *zip(*render_jobs)):
+                    if message:
+                        logged_print(message)
+        elif render_jobs:
+            # The images are independent, every worker process renders with its own PyMOL
+            # and the cores left over are given to its ray tracer
+            cpu_count = os.cpu_count() or 1
+            workers = min(len(render_jobs), max(1, cpu_count // 2))
+            with ProcessPoolExecutor(max_workers=workers, initializer=self._init_render_worker, initargs=(max(1, cpu_count // workers),)) as executor:
+                list(executor.map(self.render_from_xyz, *zip(*render_jobs)))
+
         end_time = time.time()
         execution_time = end_time - start_time
         logged_print(f"Rendering time : {execution_time} seconds")
 
+    @staticmethod
+    def _init_render_worker(max_threads):
+        # Start a headless PyMOL once per worker process
+        pymol.finish_launching(['pymol', '-cqk'])
+        cmd.set("max_threads", max_threads)
+        StructExtractor._setup_pymol()
+
+    @staticmethod
+    def _setup_pymol():
+        # Settings survive cmd.delete, so they are set once per PyMOL instance instead of per molecule.
+        # Only one molecule is loaded at a time, so the global values act like the per-object ones
+        cmd.set("sphere_scale", 0.25)
+        cmd.set("stick_radius", 0.1)
+        cmd.set("ray_opaque_background", 1)
+        cmd.set("ray_shadows", "off")
+        cmd.set("specular", "off")
+        cmd.set("light_count", 3)
+        # Plain ray tracing without outlines
+        cmd.set("ray_trace_mode", 0)
+        cmd.set("antialias", 1)
+        cmd.set("label_size", 22)
+        cmd.set("label_color", "black")
+        cmd.bg_color("white")
+
     def render_from_xyz(self, xyz_path, image_path):
         """
         Renders an image from a .xyz file using PyMOL.
         """
-        cmd.reinitialize()
+        # Only the previous molecule is removed, reinitialize would reset every setting and is much slower
+        cmd.delete("all")
         # the 1st parameter of load is the file itself
         cmd.load(xyz_path, "molecule")
         cmd.hide("everything", "molecule")
         cmd.show("sticks", "molecule")
         cmd.show("spheres", "molecule")
-        cmd.set("sphere_scale", 0.25, "molecule")
-        cmd.set("stick_radius", 0.1, "molecule")
-        cmd.set("ray_opaque_background", 1)
-        cmd.set("ray_shadows", "off")
-        cmd.set("specular", "off")
-        cmd.set("light_count", 3)
-        cmd.set("label_size", 22)
-        cmd.set("label_color", "black", "molecule")
         cmd.label("molecule", "elem")  
         #cmd.zoom("molecule", complete=1)  # zoom to contain the  whole molecule
         #cmd.orient("molecule")
         #cmd.center("molecule")
         cmd.zoom("molecule", buffer=1)
-        cmd.bg_color("white")
-        cmd.png(image_path, width=1200, height=1200, dpi=300, ray=1)
+        cmd.png(image_path, width=self.image_size, height=self.image_size, dpi=72, ray=1)
 
-    def insert_images_to_excel(self, new_excel_path, xyz_paths, scale_x=0.1, scale_y=0.1):
+    def render_from_xyz_rdkit(self, xyz_path, image_path):
+        """
+        Renders an image from a .xyz file using RDKit, without starting PyMOL.
+        Returns a warning instead of an image when RDKit cannot read the file.
+        """
+        with open(xyz_path, 'r', encoding='utf-8') as f:
+            mol = Chem.MolFromXYZBlock(f.read())
+        if mol is None:
+            return f"UnknownError: RDKit could not read {xyz_path}, skipping the image"
+        # Bonds are guessed from the interatomic distances
+        rdDetermineBonds.DetermineConnectivity(mol)
+        Draw.MolToFile(mol, image_path, size=(self.image_size, self.image_size))
+
+    def insert_images_to_excel(self, new_excel_path, xyz_paths, scale_x=0.5, scale_y=0.5, new_wb=None):
         start_time = time.time()
         
-        new_wb = load_workbook(new_excel_path)
+        # Reuse the workbook already loaded by copy_excel_and_process_data
+        if new_wb is None:
+            new_wb = load_workbook(new_excel_path)
         new_sheet = new_wb.active
         # Set column width
         new_sheet.column_dimensions['D'].width = 20
         new_sheet.column_dimensions['C'].width = 20
-    
-        for i, path_dict in enumerate(xyz_paths, start=2):
-            if self.extract_type == 1:
-                # Simultaneously extract the initial structure and optimized structure
-                opted_image_path = path_dict["opted"].replace(".xyz", ".png")
-                init_image_path = path_dict["init"].replace(".xyz", ".png")
-        
-                # Handling optimized structures
-                if opted_image_path:
-                    if os.path.exists(opted_image_path):
-                        self.insert_image_to_cell(new_sheet, 'D' + str(i), opted_image_path, scale_x, scale_y)
-                    else:
-                        new_sheet['D' + str(i)] = "UnknownError"
-                else:
-                    new_sheet['D' + str(i)] = "UnknownError"
-        
-                # Handling initial structures
-                if init_image_path:
-                    if os.path.exists(init_image_path):
-                        self.insert_image_to_cell(new_sheet, 'C' + str(i), init_image_path, scale_x, scale_y)
-                    else:
-                        new_sheet['C' + str(i)] = "UnknownError"
-                else:
-                    new_sheet['C' + str(i)] = "UnknownError"
-            elif self.extract_type == 2:
-                opted_image_path = path_dict["opted"].replace(".xyz", ".png")
-                if opted_image_path and os.path.exists(opted_image_path):
-                    self.insert_image_to_cell(new_sheet, 'D' + str(i), opted_image_path, scale_x, scale_y)
-                else:
-                    new_sheet['D' + str(i)] = "UnknownError"
+        for cell, image_path in self.image_cells(xyz_paths):
+            if image_path:
+                self.insert_image_to_cell(new_sheet, cell, image_path, scale_x, scale_y)
+            else:
+                new_sheet[cell] = "UnknownError"
         new_wb.save(new_excel_path)
         end_time = time.time()
         execution_time = end_time - start_time
         logged_print(f"Inserting time : {execution_time} seconds\n")
 
+    def image_cells(self, xyz_paths):
+        """ Return (cell, image path) pairs, the image path is None where no image was rendered """
+        # Optimized structures go to column D, initial structures to column C
+        columns = [('D', "opted")]
+        if self.extract_type == 1:
+            columns.append(('C', "init"))
+        cells = []
+        for i, path_dict in enumerate(xyz_paths, start=2):
+            for column, key in columns:
+                image_path = path_dict[key].replace(".xyz", ".png")
+                cells.append((column + str(i), image_path if image_path and os.path.exists(image_path) else None))
+        return cells
+
+    def thumbnail_data(self, image_path, scale_x, scale_y):
+        # The PNG is shrunk to its on-sheet size, so the workbook does not store the full rendering
+        with PILImage.open(image_path) as img:
+            img.thumbnail((max(1, int(img.width * scale_x)), max(1, int(img.height * scale_y))), PILImage.LANCZOS)
+            image_data = io.BytesIO()
+            img.save(image_data, format='PNG', optimize=True)
+        image_data.seek(0)
+        return image_data
+
     def insert_image_to_cell(self, sheet, cell, image_path, scale_x, scale_y):
-        img = Image(image_path)
-        img.width, img.height = img.width * scale_x, img.height * scale_y
+        img = Image(self.thumbnail_data(image_path, scale_x, scale_y))
         sheet.add_image(img, cell)
         sheet.row_dimensions[int(cell[1:])].height = 100  # Update row height
 
@@ -366,12 +524,12 @@ class StructExtractor():
             user_input_result = self.handle_user_input()
             if user_input_result == 'r':
                 return
-            new_excel_path, file_names = self.copy_excel_and_process_data(self.excel_file_path)
+            new_excel_path, file_names, new_wb = self.copy_excel_and_process_data(self.excel_file_path)
             if new_excel_path is None or file_names is None:
                 continue
             xyz_paths = self.generate_xyz(file_names)
             self.process_xyz_files(xyz_paths)
-            self.insert_images_to_excel(new_excel_path, xyz_paths)
+            self.insert_images_to_excel(new_excel_path, xyz_paths, new_wb=new_wb)
             break
         
         end_time = datetime.now()
@@ -5,13 +5,18 @@
 '''
 
 import os
+import sys
+import json
 import time
+import hashlib
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from logcreator import logged_input, logged_print
-from prompt_toolkit import PromptSession
-from prompt_toolkit.completion import WordCompleter
 
 '''
     Implement batch modification of gjf input files.
@@ -22,53 +27,183 @@ from prompt_toolkit.completion import WordCompleter
     Add a tab key auto-completion feature: use the latest pyreadline3 instead of readline.
 '''
 
+# Element symbol -> atomic number, read-only
+ELEM_DICT = MappingProxyType({'H': 1, 'He': 2, 'Li': 3, 'Be': 4, 'B': 5, 'C': 6, 'N': 7, 'O': 8, 'F': 9, 'Ne': 10,
+                'Na': 11, 'Mg': 12, 'Al': 13, 'Si': 14, 'P': 15, 'S': 16, 'Cl': 17, 'Ar': 18, 'K': 19, 'Ca': 20,
+                'Sc': 21, 'Ti': 22, 'V': 23, 'Cr': 24, 'Mn': 25, 'Fe': 26, 'Co': 27, 'Ni': 28, 'Cu': 29, 'Zn': 30,
+                'Ga': 31, 'Ge': 32, 'As': 33, 'Se': 34, 'Br': 35, 'Kr': 36, 'Rb': 37, 'Sr': 38, 'Y': 39, 'Zr': 40,
+                'Nb': 41, 'Mo': 42, 'Tc': 43, 'Ru': 44, 'Rh': 45, 'Pd': 46, 'Ag': 47, 'Cd': 48, 'In': 49, 'Sn': 50,
+                'Sb': 51, 'Te': 52, 'I': 53, 'Xe': 54, 'Cs': 55, 'Ba': 56, 'La': 57, 'Ce': 58, 'Pr': 59, 'Nd': 60,
+                'Pm': 61, 'Sm': 62, 'Eu': 63, 'Gd': 64, 'Tb': 65, 'Dy': 66, 'Ho': 67, 'Er': 68, 'Tm': 69, 'Yb': 70,
+                'Lu': 71, 'Hf': 72, 'Ta': 73, 'W': 74, 'Re': 75, 'Os': 76, 'Ir': 77, 'Pt': 78, 'Au': 79, 'Hg': 80,
+                'Tl': 81, 'Pb': 82, 'Bi': 83, 'Po': 84, 'At': 85, 'Rn': 86, 'Fr': 87, 'Ra': 88, 'Ac': 89, 'Th': 90,
+                'Pa': 91, 'U': 92, 'Np': 93, 'Pu': 94, 'Am': 95, 'Cm': 96, 'Bk': 97, 'Cf': 98, 'Es': 99, 'Fm': 100,
+                'Md': 101, 'No': 102, 'Lr': 103, 'Rf': 104, 'Db': 105, 'Sg': 106, 'Bh': 107, 'Hs': 108, 'Mt': 109,
+                'Ds': 110, 'Rg': 111, 'Cn': 112, 'Nh': 113, 'Fl': 114, 'Mc': 115, 'Lv': 116, 'Ts': 117, 'Og': 118})
+
+# Autocomplete list of options
+COMPLETION_OPTIONS = (
+    'def2-tzvp', 'def2-tzvpd', 'def2-tzvpp', 'def2-tzvppd',
+    '6-311g', '6-311g*', '6-311+g', '6-311+g*', '6-311+g**', '6-311g(d,p)',
+    'cc-pVTZ', 'cc-pVQZ', 'cc-pVDZ', 'cc-pV5Z',
+    'aug-cc-pVDZ', 'aug-cc-pVTZ', 'aug-cc-pVQZ', 'aug-cc-pV5Z'
+)
+# WordCompleter shared by all instances, created with the first PromptSession
+COMPLETER = None
+# Basis set data already downloaded in this session, (basis, elements, fmt) -> data, shared by all instances
+BASIS_DATA = {}
+BASIS_DATA_SIZE = 64
+
 class GjfGenerator():
 
     def __init__(self):
         self.BASE_URL = "https://www.basissetexchange.org"
+        # Responses of the basis set exchange are kept on disk for a day
+        self.cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "chemauto")
+        self.cache_ttl = 86400
+        self._metadata = None
+        # Lowercase basis name -> metadata key, and the supported elements of every checked basis
+        self._name_index = None
+        self._basis_elements = {}
+        # Lowercase basis name -> (name, elements) from the basis' own json, None for an unknown name
+        self._basis_probe = {}
+        # One session keeps the connection alive between requests, transient server errors are retried
+        self.http = requests.Session()
+        self.http.mount('https://', HTTPAdapter(pool_maxsize=4, max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])))
         
-        self.elemDict ={'H': 1, 'He': 2, 'Li': 3, 'Be': 4, 'B': 5, 'C': 6, 'N': 7, 'O': 8, 'F': 9, 'Ne': 10,
-                    'Na': 11, 'Mg': 12, 'Al': 13, 'Si': 14, 'P': 15, 'S': 16, 'Cl': 17, 'Ar': 18, 'K': 19, 'Ca': 20, 
-                    'Sc': 21, 'Ti': 22, 'V': 23, 'Cr': 24, 'Mn': 25, 'Fe': 26, 'Co': 27, 'Ni': 28, 'Cu': 29, 'Zn': 30, 
-                    'Ga': 31, 'Ge': 32, 'As': 33, 'Se': 34, 'Br': 35, 'Kr': 36, 'Rb': 37, 'Sr': 38, 'Y': 39, 'Zr': 40, 
-                    'Nb': 41, 'Mo': 42, 'Tc': 43, 'Ru': 44, 'Rh': 45, 'Pd': 46, 'Ag': 47, 'Cd': 48, 'In': 49, 'Sn': 50, 
-                    'Sb': 51, 'Te': 52, 'I': 53, 'Xe': 54, 'Cs': 55, 'Ba': 56, 'La': 57, 'Ce': 58, 'Pr': 59, 'Nd': 60, 
-                    'Pm': 61, 'Sm': 62, 'Eu': 63, 'Gd': 64, 'Tb': 65, 'Dy': 66, 'Ho': 67, 'Er': 68, 'Tm': 69, 'Yb': 70, 
-                    'Lu': 71, 'Hf': 72, 'Ta': 73, 'W': 74, 'Re': 75, 'Os': 76, 'Ir': 77, 'Pt': 78, 'Au': 79, 'Hg': 80, 
-                    'Tl': 81, 'Pb': 82, 'Bi': 83, 'Po': 84, 'At': 85, 'Rn': 86, 'Fr': 87, 'Ra': 88, 'Ac': 89, 'Th': 90, 
-                    'Pa': 91, 'U': 92, 'Np': 93, 'Pu': 94, 'Am': 95, 'Cm': 96, 'Bk': 97, 'Cf': 98, 'Es': 99, 'Fm': 100, 
-                    'Md': 101, 'No': 102, 'Lr': 103, 'Rf': 104, 'Db': 105, 'Sg': 106, 'Bh': 107, 'Hs': 108, 'Mt': 109, 
-                    'Ds': 110, 'Rg': 111, 'Cn': 112, 'Nh': 113, 'Fl': 114, 'Mc': 115, 'Lv': 116, 'Ts': 117, 'Og': 118}
-        
-        # Autocomplete list of options
-        self.COMPLETION_OPTIONS = [
-            'def2-tzvp', 'def2-tzvpd', 'def2-tzvpp', 'def2-tzvppd',
-            '6-311g', '6-311g*', '6-311+g', '6-311+g*', '6-311+g**', '6-311g(d,p)',
-            'cc-pVTZ', 'cc-pVQZ', 'cc-pVDZ', 'cc-pV5Z',
-            'aug-cc-pVDZ', 'aug-cc-pVTZ', 'aug-cc-pVQZ', 'aug-cc-pV5Z'
-        ]
-        # Create a completer using WordCompleter
-        self.completer = WordCompleter(self.COMPLETION_OPTIONS, ignore_case=True)
-        # Create PromptSession instance
-        self.session = PromptSession(completer=self.completer)
+
+        # Static tables are shared by all instances
+        self.elemDict = ELEM_DICT
+        self.COMPLETION_OPTIONS = COMPLETION_OPTIONS
+        self.completer = None
+        # PromptSession instance, created at the first prompt
+        self.session = None
+
+    def get_session(self):
+        global COMPLETER
+        if self.session is None:
+            # prompt_toolkit is only imported once a prompt is shown
+            from prompt_toolkit import PromptSession
+            from prompt_toolkit.completion import WordCompleter
+            if COMPLETER is None:
+                COMPLETER = WordCompleter(COMPLETION_OPTIONS, ignore_case=True)
+            self.completer = COMPLETER
+            self.session = PromptSession(completer=self.completer)
+        return self.session
+
+    def _prompt(self, message):
+        # Piped input or CI has no terminal for prompt_toolkit, a plain input() is enough there
+        if sys.stdin is not None and sys.stdin.isatty():
+            return self.get_session().prompt(message)
+        return input(message)
     
+    def _cached_get(self, url, separator=None):
+        """GET url and return the response text, a fresh copy on disk is returned without a request.
+        With a separator only the text after its last occurrence is kept."""
+        cache_key = url if separator is None else url + '\n' + separator
+        cache_file = os.path.join(self.cache_dir, hashlib.sha1(cache_key.encode('utf-8')).hexdigest() + '.json')
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if time.time() - cached['fetched_at'] < self.cache_ttl:
+                return cached['body']
+        except (OSError, ValueError, KeyError):
+            pass
+        if separator is None:
+            r = self.http.get(url, timeout=(3.05, 30))
+            # Failed responses raise and are never cached
+            r.raise_for_status()
+            body = r.text
+        else:
+            with self.http.get(url, stream=True, timeout=(3.05, 60)) as r:
+                r.raise_for_status()
+                body = self._stream_tail(r, separator)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(cache_file, 'w', encoding='utf-8') as f:
+                json.dump({'fetched_at': time.time(), 'body': body}, f)
+        except OSError:
+            pass
+        return body
+
+    def _stream_tail(self, r, separator):
+        # The text before a separator is dropped as soon as the separator arrives, instead of splitting the whole body
+        if r.encoding is None:
+            r.encoding = 'utf-8'
+        # A separator may be cut by a chunk boundary, so the last len(separator) - 1 characters are held back
+        overlap = len(separator) - 1
+        kept = []
+        buffer = ''
+        for chunk in r.iter_content(chunk_size=65536, decode_unicode=True):
+            buffer += chunk
+            index = buffer.rfind(separator)
+            if index != -1:
+                kept = []
+                buffer = buffer[index + len(separator):]
+            if len(buffer) > overlap:
+                kept.append(buffer[:len(buffer) - overlap])
+                buffer = buffer[len(buffer) - overlap:]
+        kept.append(buffer)
+        return ''.join(kept)
+
+    def get_metadata(self):
+        # Loaded once per session, later checks skip even the disk cache
+        if self._metadata is None:
+            self._metadata = json.loads(self._cached_get(self.BASE_URL + '/api/metadata'))
+            self._name_index = {}
+            for name in self._metadata:
+                # The first name wins, as with the former linear scan
+                self._name_index.setdefault(name.lower(), name)
+            self._basis_elements = {}
+        return self._metadata
+
+    def probe_basis(self, basis_lower, numbers):
+        """Get which of the element numbers one basis set supports without the whole metadata, None if the name is unknown"""
+        key = (basis_lower, numbers)
+        if key not in self._basis_probe:
+            try:
+                # Only the requested elements are downloaded, a missing one is not supported
+                data = json.loads(self._cached_get(f"{self.BASE_URL}/api/basis/{basis_lower}/format/json/?elements={','.join(numbers)}"))
+                self._basis_probe[key] = frozenset(data['elements'])
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                # Unknown name, the metadata tells whether it is really not supported
+                self._basis_probe[key] = None
+        return self._basis_probe[key]
+
     def check_basis_elem(self, basis, elements):
         """Check if the basis set is supported, case-insensitive, and return the basis set name and a list of element numbers"""
-        r = requests.get(self.BASE_URL + '/api/metadata')
-        if r.ok:
-            metadata = r.json()
-            basis_matched = None
-            for name in metadata.keys():
-                if name.lower() == basis.replace('*', '_st_').lower():
-                    basis = name
-                    basis_matched = True
-                    break
+        basis_lower = basis.replace('*', '_st_').lower()
+        # Format the input element list
+        elements = [elem.strip().capitalize() for elem in elements.split(',')]
+        numbers = tuple(str(self.elemDict[elem]) for elem in elements if elem in self.elemDict)
+        probed = None
+        # The metadata of every basis set is only downloaded when the basis set's own json can't be used
+        if self._metadata is None and numbers:
+            try:
+                probed = self.probe_basis(basis_lower, numbers)
+            except (requests.RequestException, ValueError, KeyError, TypeError):
+                probed = None
+        if probed is not None:
+            # The transformed name is the one used by the metadata, the download URLs and the caches
+            metadata = None
+            basis, elements_list = basis_lower, probed
+        else:
+            try:
+                metadata = self.get_metadata()
+            except (requests.RequestException, ValueError):
+                metadata = None
+        if probed is not None or metadata:
+            basis_matched = basis if probed is not None else self._name_index.get(basis_lower)
             if basis_matched:
+                basis = basis_matched
                 #print(f"Basis set {basis} is supported.\n")
-                latest_version = metadata[basis]["latest_version"]
-                elements_list = metadata[basis]["versions"][latest_version]["elements"]
-                # Format the input element list
-                elements = [elem.strip().capitalize() for elem in elements.split(',')]
+                if metadata:
+                    if basis not in self._basis_elements:
+                        latest_version = metadata[basis]["latest_version"]
+                        self._basis_elements[basis] = frozenset(metadata[basis]["versions"][latest_version]["elements"])
+                    elements_list = self._basis_elements[basis]
                 unsupported_elements = []
                 # Check if each element is supported
                 for elem in elements:
@@ -89,36 +224,46 @@ class GjfGenerator():
             logged_print(f"Failed to fetch basis set metadata.")
             return False
     
+    def _fetch_basis_raw(self, basis_lower, elements_key, fmt):
+        """Get basis set data and delete the header information, memory first, then the disk cache, then the network"""
+        key = (basis_lower, elements_key, fmt)
+        if key in BASIS_DATA:
+            # Move to the end, the oldest entry is dropped first
+            BASIS_DATA[key] = BASIS_DATA.pop(key)
+            return BASIS_DATA[key]
+        url = f"{self.BASE_URL}/api/basis/{basis_lower}/format/{fmt}/?elements={','.join(elements_key)}"
+        # Delete header information while downloading, failed downloads raise and are not kept
+        data = self._cached_get(url, separator='!----------------------------------------------------------------------')
+        data = data.strip() + "\n"*5
+        if len(BASIS_DATA) >= BASIS_DATA_SIZE:
+            del BASIS_DATA[next(iter(BASIS_DATA))]
+        BASIS_DATA[key] = data
+        return data
+
     def getBasis(self, basis, elements, fmt='gaussian94'):
             result = self.check_basis_elem(basis, elements)
             #print(result)
             if result:
                 basis, elements = result
-                """Get basis set data and delete the header information"""
-                elements_param = ','.join(elements)
-                #print(elements_param)
-                url = f"{self.BASE_URL}/api/basis/{basis.lower()}/format/{fmt}/?elements={elements_param}"
-                #print(url)
-                r = requests.get(url)
-                if r.ok:
-                    data = r.text
-                    # Delete header information
-                    data = data.split('!----------------------------------------------------------------------')[-1].strip() + "\n"*5
-                    return data
-                else:
-                    print("Error fetching basis set:", r.status_code)
+                try:
+                    return self._fetch_basis_raw(basis.lower(), tuple(elements), fmt)
+                except requests.HTTPError as e:
+                    print("Error fetching basis set:", e.response.status_code)
+                    return None
+                except requests.RequestException as e:
+                    print("Error fetching basis set:", e)
                     return None
             else:
                 logged_print("Operation aborted due to unsupported basis set or elements.")
     
     def pretreatment(self):
-        link0 = self.session.prompt("Please input link0 (enter 'q' to return):")
+        link0 = self._prompt("Please input link0 (enter 'q' to return):")
         if link0.strip().lower() == 'q':
             return 'r'
-        basis = self.session.prompt("Please input basis set name (leave empty if not required, 'q' to return):")
+        basis = self._prompt("Please input basis set name (leave empty if not required, 'q' to return):")
         if basis.strip().lower() == 'q':
             return 'r'
-        elements = self.session.prompt("Please input the elements separated by commas (e.g., H,C,O) (leave empty if not required, 'q' to return):")
+        elements = self._prompt("Please input the elements separated by commas (e.g., H,C,O) (leave empty if not required, 'q' to return):")
         if elements.strip().lower() == 'q':
             return 'r'
         
@@ -132,43 +277,56 @@ class GjfGenerator():
             content = link0 + "\n\nMark\n\n\n" + data
         return content
     
-    def process_file(self, file_path, output_folder, content, insert_after_line=4):
-        os.makedirs(output_folder, exist_ok=True)
-        filename = os.path.basename(file_path)
-        with open(file_path, 'r') as file:
-            lines = file.readlines()
-        i = -1
-        j = -1
-        for index, line in enumerate(lines):
-            if line.startswith('-1') or line.startswith('0'):
-                i = index
-                break
-        for index in range(i + 1, len(lines)):
-            if lines[index].strip() == '':
-                j = index
+    def split_template(self, content, insert_after_line=4):
+        """Split the template into the encoded text before and after the molecule block"""
+        # Walk to the end of the insert_after_line-th line instead of splitting every line
+        split_at = 0
+        for _ in range(insert_after_line):
+            newline_at = content.find('\n', split_at)
+            if newline_at == -1:
+                split_at = len(content)
                 break
-        if i != -1 and j != -1:
-            content_to_insert = lines[i:j]
-        else:
-            content_to_insert = []
-        lines = content.splitlines(keepends=True)
-        for i, new_line in enumerate(content_to_insert):
-            # List index started from 0
-            lines.insert(insert_after_line + i, new_line)
-        # Merge list of lines back into a string
-        new_content = ''.join(lines)
-        with open(os.path.join(output_folder, filename), 'w') as file:
-            file.writelines(new_content)
+            split_at = newline_at + 1
+        # Encoded once for the whole batch, with the newline text mode would have written
+        head = content[:split_at].replace('\n', os.linesep).encode('utf-8')
+        tail = content[split_at:].replace('\n', os.linesep).encode('utf-8')
+        return head, tail
+
+    def process_file(self, file_path, output_folder, head, tail, create_folder=True):
+        # The folder batch creates output_folder once and skips this
+        if create_folder:
+            os.makedirs(output_folder, exist_ok=True)
+        filename = os.path.basename(file_path)
+        # Only the lines from the charge/multiplicity line up to the next blank line are kept
+        content_to_insert = []
+        charge_lines = None
+        newline = os.linesep.encode('ascii')
+        with open(file_path, 'rb') as file:
+            for line in file:
+                if charge_lines is None:
+                    if line.startswith((b'-1', b'0')):
+                        charge_lines = [line]
+                elif line.strip() == b'':
+                    # Without the closing blank line nothing is inserted
+                    content_to_insert = [charge_line.rstrip(b'\r\n') + newline for charge_line in charge_lines]
+                    break
+                else:
+                    charge_lines.append(line)
+        # The template was split once by the caller, the block goes in between with one write
+        with open(os.path.join(output_folder, filename), 'wb') as file:
+            file.write(head + b''.join(content_to_insert) + tail)
     
-    def process_files_in_folder(self, folder, output_folder, content):
-        for filename in os.listdir(folder):
-            if filename.endswith('.gjf'):
-                file_path = os.path.join(folder, filename)
-                self.process_file(file_path, output_folder, content)
+    def process_files_in_folder(self, folder, output_folder, head, tail):
+        os.makedirs(output_folder, exist_ok=True)
+        with os.scandir(folder) as entries:
+            file_paths = [entry.path for entry in entries if entry.name.endswith('.gjf')]
+        # Every file is a small read and write, threads overlap the waits on the disk
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            list(executor.map(lambda file_path: self.process_file(file_path, output_folder, head, tail, create_folder=False), file_paths))
 
     def get_valid_input_path(self):
         while True:
-            input_path = self.session.prompt("Please input the path of a gjf file or a folder containing gjf files (enter 'r' to return): \n")
+            input_path = self._prompt("Please input the path of a gjf file or a folder containing gjf files (enter 'r' to return): \n")
             if input_path.strip().lower() == 'q':
                 print("Program terminated!")
                 return 'r'
@@ -179,7 +337,7 @@ class GjfGenerator():
     
     def get_valid_output_path(self, input_path):
         while True:
-            output_path = self.session.prompt("Please input the folder to save processed files (press Enter to overwrite, enter 'r' to return): \n")
+            output_path = self._prompt("Please input the folder to save processed files (press Enter to overwrite, enter 'r' to return): \n")
             if output_path.strip().lower() == 'r':
                 return 'r'
             elif output_path.strip() == '':
@@ -196,15 +354,17 @@ class GjfGenerator():
                 return output_path
     
     def process_input_path(self, input_path, output_path, content):
-        start_time = time.time()
+        start_counter = time.perf_counter_ns()
+        # The template is the same for every file
+        head, tail = self.split_template(content, insert_after_line=4)
         if os.path.isfile(input_path) and input_path.endswith('.gjf'):
-            self.process_file(input_path, output_path, content, insert_after_line=4)
+            self.process_file(input_path, output_path, head, tail)
         elif os.path.isdir(input_path):
-            self.process_files_in_folder(input_path, output_path, content)
+            self.process_files_in_folder(input_path, output_path, head, tail)
         else:
             logged_print("ERROR: Invalid input path. Please provide a valid .gjf file or directory.")
-        end_time = time.time()
-        logged_print(f"Runing time：{end_time - start_time}s\nSuccessful!!!")
+        end_counter = time.perf_counter_ns()
+        logged_print(f"Runing time：{(end_counter - start_counter) / 1e9}s\nSuccessful!!!")
         
     def run(self):
         start_time = datetime.now() 
@@ -7,7 +7,10 @@
 '''
 
 import os
+import queue
+import atexit
 import logging
+import logging.handlers
 from datetime import datetime, timedelta
 
 def setup_logging():
@@ -16,11 +19,45 @@ def setup_logging():
     if not os.path.exists(log_file):
         open(log_file, 'w').close()
 
+    # Already configured, like basicConfig does
+    if logging.getLogger().handlers:
+        return
     #Config log settings
-    logging.basicConfig(filename=log_file, 
-                        level=logging.INFO, 
-                        format='%(asctime)s - %(message)s', 
-                        datefmt='%Y-%m-%d %H:%M:%S')
+    file_handler = _file_handler(log_file)
+    # Records are written to the file 16 at a time, errors are written at once, so a killed session loses only a few lines
+    memory_handler = logging.handlers.MemoryHandler(capacity=16, flushLevel=logging.ERROR, target=file_handler)
+    # The file is written by a background listener, logging.info only puts the record on the queue
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, memory_handler, respect_handler_level=True)
+    listener.start()
+    # atexit runs last registered first: drain the queue, then write the buffered records
+    atexit.register(memory_handler.close)
+    atexit.register(listener.stop)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Only the message is put on the queue, the time stamp is added by file_handler
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    # The queue only serves the main process. A forked worker gets a copy of it that nobody drains,
+    # so the worker writes its records straight to the file instead
+    if hasattr(os, 'register_at_fork'):
+        # The records logged so far are written first, so they stay ahead of the worker records in the file
+        os.register_at_fork(before=lambda: _write_pending(log_queue, memory_handler),
+                            after_in_child=lambda: _log_to_file_in_child(queue_handler, log_file))
+
+def _file_handler(log_file):
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    return file_handler
+
+def _write_pending(log_queue, memory_handler):
+    # The listener marks every record as done, so join returns once they all reached memory_handler
+    log_queue.join()
+    memory_handler.flush()
+
+def _log_to_file_in_child(queue_handler, log_file):
+    root = logging.getLogger()
+    root.removeHandler(queue_handler)
+    root.addHandler(_file_handler(log_file))
 
 def clean_logs():
     log_file = 'chemauto.log'
@@ -4,13 +4,39 @@
     Last update : 2024-04-05
 '''
 
+import multiprocessing
 from datetime import datetime
 from logcreator import *
-from analyzer import GaussianLogAnalyzer
-from extractor import StructExtractor
-from generator import GjfGenerator
-from exporter import PesExporter
-from pylinkor import AutoDOS
+
+# The imports stay static inside the loaders, so PyInstaller still finds the modules for the .exe
+def _load_analyzer():
+    from analyzer import GaussianLogAnalyzer
+    return GaussianLogAnalyzer
+
+def _load_extractor():
+    from extractor import StructExtractor
+    return StructExtractor
+
+def _load_generator():
+    from generator import GjfGenerator
+    return GjfGenerator
+
+def _load_exporter():
+    from exporter import PesExporter
+    return PesExporter
+
+def _load_pylinkor():
+    from pylinkor import AutoDOS
+    return AutoDOS
+
+# Menu option -> loader, each module is imported when its option is first chosen
+DISPATCH = {
+    '1': _load_analyzer,
+    '2': _load_extractor,
+    '3': _load_generator,
+    '4': _load_exporter,
+    '5': _load_pylinkor,
+}
 
 def main_menu():
     clean_logs()
@@ -20,21 +46,10 @@ def main_menu():
     logged_print(f"\nProgram started at {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
     while True:
         choice = logged_input("\n 1. Log files analysis. \n 2. Extract Structures. \n 3. Create gjf files. \n 4. Generate PES plotting data. \n 5. Generate DOS in ogg format.\n ")
-        if choice == '1':
-            analyzer = GaussianLogAnalyzer()
-            analyzer.run()
-        elif choice == '2':
-            extractor = StructExtractor()
-            extractor.run()
-        elif choice == '3':
-            generator = GjfGenerator()
-            generator.run()
-        elif choice == '4':
-            plotter = PesExporter()
-            plotter.run()
-        elif choice == '5':
-            dos_generator = AutoDOS()
-            dos_generator.run()
+        loader = DISPATCH.get(choice)
+        if loader:
+            # The menu shows up without loading every module, sys.modules keeps the ones already imported
+            loader()().run()
         elif choice.strip().lower() == 'q':
             logged_print("Exiting the program.")
             break
@@ -48,4 +63,6 @@ def main_menu():
     logged_print(f"Total duration: {minutes} minutes {seconds} seconds")
 
 if __name__ == "__main__":
+    # Needed by the analyzer worker processes in the frozen .exe build
+    multiprocessing.freeze_support()
     main_menu()
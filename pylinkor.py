@@ -10,9 +10,21 @@ import os
 import time
 import json
 import logging
+import functools
+import multiprocessing.util
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from logcreator import logged_input, logged_print
-import originpro as op
+import numpy as np
+# orjson is faster to read the config file, the standard json is used without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Answers that leave an input loop, 'q' alone leaves the file path prompts
+QUIT = frozenset({'q', 'r'})
+QUIT_ONLY = frozenset({'q'})
 
 """
     Last Update: 2024-04-05
@@ -61,63 +73,77 @@ class AutoDOS():
             "template_path": "D:\\Program Files\\OriginLab\\UserFiles\\DOS-default.otpu",
             "default_x_range": [0, 3.3],
             "default_y_range": [-0.03, 6.5],
-            "show_graph": False
+            "show_graph": False,
+            # Every batch worker runs a full Origin instance, with its memory and licence seat
+            "max_origin_instances": 2
         }
         self.config = self.load_or_update_config()
+        # The template is resolved and checked once instead of by every plot
+        self.template_path = os.path.abspath(self.config["template_path"])
+        self.template_found = os.path.isfile(self.template_path)
 
     def load_or_update_config(self):
-        if os.path.exists(self.config_file_path):
-            with open(self.config_file_path, 'r') as file:
+        # The file is only written when it is missing, broken or lacks a key
+        dirty = not os.path.exists(self.config_file_path)
+        if not dirty:
+            with open(self.config_file_path, 'rb') as file:
                 try:
                     # try to load current config
-                    config = json.load(file)
-                except json.JSONDecodeError:
+                    config = orjson.loads(file.read()) if orjson else json.loads(file.read())
+                except ValueError:
+                    # json.JSONDecodeError and orjson.JSONDecodeError are both ValueError
                     config = {}
+                    dirty = True
             # Update current config
             for key, value in self.default_config.items():
                 if key not in config:
                     config[key] = value
+                    dirty = True
         else:
             config = self.default_config
+        if not dirty:
+            return config
+        # The file is shared with the exporter, so it is written in the same 4-space json format
         with open(self.config_file_path, 'w') as file:
             json.dump(config, file, indent=4)
         return config
         
-    def process_file(self, curve_file_path=None, line_file_path=None, xlim_values=None, exit_origin = True):
+    def process_file(self, curve_file_path=None, line_file_path=None, xlim_values=None, ylim_values=None, template_path=None, show_graph=None, exit_origin = True, fresh_session = True):
         """
             Process the given curve and line files, create graphics and save.
         """
+        if template_path is None and not self.template_found:
+            logged_print(f"Template not found: {self.template_path}\nPlease check template_path in {self.config_file_path}.")
+            return 'r'
         if not curve_file_path or not line_file_path:
             logged_print("Parameter Error. Please input the required parameter.\n")
-            while True:
-                if not curve_file_path:
-                    curve_file_path = logged_input("Input curve data file path (enter 'q' to return):\n")
-                    if curve_file_path.strip().lower() == 'q':
-                        return 'r'
-                    elif not curve_file_path.endswith("_curve.txt"):
-                        logged_print("Invalid curve data file path. Please ensure the file ends with '_curve.txt'.")
-                        curve_file_path = None
-                        continue
-                    else:
-                        break
+            # The input is stripped once, stray spaces don't invalidate a path
+            while not curve_file_path:
+                raw = logged_input("Input curve data file path (enter 'q' to return):\n").strip()
+                cmd = raw.lower()
+                if cmd in QUIT_ONLY:
+                    return 'r'
+                elif not raw.endswith("_curve.txt"):
+                    logged_print("Invalid curve data file path. Please ensure the file ends with '_curve.txt'.")
+                else:
+                    curve_file_path = raw
         
-            while True:
-                if not line_file_path:
-                    line_file_path = logged_input("Input line data file path (enter 'q' to return):\n")
-                    if line_file_path.strip().lower() == 'q':
-                        return 'r'
-                    elif not line_file_path.endswith("_line.txt"):
-                        logged_print("Invalid line data file path. Please ensure the file ends with '_line.txt'.")
-                        line_file_path = None  # Reset
-                        continue
-                    else:
-                        break
+            while not line_file_path:
+                raw = logged_input("Input line data file path (enter 'q' to return):\n").strip()
+                cmd = raw.lower()
+                if cmd in QUIT_ONLY:
+                    return 'r'
+                elif not raw.endswith("_line.txt"):
+                    logged_print("Invalid line data file path. Please ensure the file ends with '_line.txt'.")
+                else:
+                    line_file_path = raw
         # No user defined xlim_values, using default value
         if xlim_values is None:
             default_x_range = self.config.get("default_x_range", [0, 3.3])
             while True:
                 x_range = logged_input(f"Please input the x range of DOS spectrum in the format 'start,end' (default is {default_x_range[0]},{default_x_range[1]}):\n").strip()
-                if x_range.strip().lower() == 'q' or x_range.strip().lower() == 'r':
+                cmd = x_range.lower()
+                if cmd in QUIT:
                     print("Return to last menu!")
                     return
                 elif not x_range:
@@ -138,20 +164,28 @@ class AutoDOS():
                     # Transfer failed, input again.
                     logged_print("Invalid input format. Please input two numbers separated by a comma (e.g., 0,3.3).")
 
-        # Get parameters and prepare file paths
-        ylim_values = self.config.get("default_y_range", [0, 6.5])
-        template_path = self.config["template_path"]
-        show_graph = self.config.get("show_graph", False)
+        # Get parameters not given by the caller and prepare file paths
+        if ylim_values is None:
+            ylim_values = self.config.get("default_y_range", [0, 6.5])
+        if template_path is None:
+            template_path = self.template_path
+        if show_graph is None:
+            show_graph = self.config.get("show_graph", False)
         file_name = os.path.basename(os.path.dirname(curve_file_path))
         file_suffix = file_name.split('-')[-1] if '-' in file_name else file_name
         ogg_save_path = os.path.join(os.path.dirname(curve_file_path), f"{file_name}.ogg")
         opju_save_path = os.path.join(os.path.dirname(curve_file_path), f"{file_name}.opju")
 
-        # Start plotting
+        # Start plotting, Origin is only loaded once a graph is drawn
+        import originpro as op
         s = time.time()
-        op.new()
-        op.set_show(show_graph)
-        wb = op.find_book()
+        if fresh_session:
+            op.new()
+            op.set_show(show_graph)
+            wb = op.find_book()
+        else:
+            # The session is reused, the book of the last plot was destroyed
+            wb = op.new_book()
         wb.lname = f'{file_name}_wb'
         wb.name = wb.lname
         wks = op.find_sheet().destroy()
@@ -159,8 +193,8 @@ class AutoDOS():
         wks_curve.name = f'{file_name}_curve'
         wks_line = wb.add_sheet(name = f'{file_name}_line')
         wks_line.name = f'{file_name}_line'
-        wks_curve.from_file(curve_file_path)
-        wks_line.from_file(line_file_path)
+        self._fill_sheet(wks_curve, curve_file_path)
+        self._fill_sheet(wks_line, line_file_path)
         gp = op.new_graph(template = template_path)
         gl = gp[0]
         gl.add_plot(wks_curve, coly=1, colx=0, type='l')
@@ -172,12 +206,13 @@ class AutoDOS():
         gp.lname = f'{file_name}'
         gp.name = gp.lname
 
-        # Set properties through .lt_exec method
-        op.lt_exec(f'label -p 10 10 -n l "{file_suffix}";')
-        op.lt_exec('l.font=font("Arial");')
-        op.lt_exec('l.fsize=30;')
-        op.lt_exec(f'save -ix "{ogg_save_path}";')
+        # Set properties and export through one .lt_exec call, every call is a round trip to Origin
+        op.lt_exec(f'label -p 10 10 -n l "{file_suffix}"; l.font=font("Arial"); l.fsize=30; save -ix "{ogg_save_path}";')
         op.save(f'{opju_save_path}')
+        if not fresh_session:
+            # Free the plot so the next one starts from an empty project
+            gp.destroy()
+            wb.destroy()
         e = time.time()
         r = e - s
         print("Time: {:.2f} seconds".format(r))
@@ -200,25 +235,71 @@ class AutoDOS():
             #op.lt_exec(f'page.lname$ = "{file_name}";')
         '''
 
+    @staticmethod
+    def _load_two_col(file_path):
+        # The exporter writes tab separated columns, rows without a y value (the breaks of the line data) get NaN
+        return np.genfromtxt(file_path, delimiter='\t', usecols=(0, 1), filling_values=np.nan, dtype=np.float64, ndmin=2)
+
+    def _fill_sheet(self, wks, file_path):
+        if os.path.getsize(file_path) == 0:
+            # Nothing to parse, Origin's ASCII import handles the empty file as before
+            wks.from_file(file_path)
+            return
+        data = self._load_two_col(file_path)
+        # NaN values are shown as missing values by Origin, like the empty cells of from_file
+        wks.from_list(0, data[:, 0].tolist())
+        wks.from_list(1, data[:, 1].tolist())
+
+    def _find_pairs(self, folder_path, top=True):
+        """
+            Yield the (curve, line) files of every subfolder containing both, each folder is listed once by scandir.
+        """
+        curve_file = None
+        line_file = None
+        sub_folders = []
+        try:
+            with os.scandir(folder_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_folders.append(entry.path)
+                        continue
+                    # Fixed length tails are compared, len("_curve.txt") == 10 and len("_line.txt") == 9
+                    name = entry.name
+                    if name[-10:] == "_curve.txt":
+                        curve_file = entry.path
+                    elif name[-9:] == "_line.txt":
+                        line_file = entry.path
+        except OSError:
+            # Unreadable folders are skipped, as os.walk did
+            return
+        # Files directly in the chosen folder are not plotted, only those in its subfolders
+        if not top and curve_file and line_file:
+            yield curve_file, line_file
+        for sub_folder_path in sub_folders:
+            yield from self._find_pairs(sub_folder_path, top=False)
+
     def process_folder(self, folder_path=None):
         """
             Traverse all subfolders within a given folder, locate and process files ending with *_curve.txt and *_line.txt.
         """
-        while True:
-            if not folder_path:
-                folder_path = logged_input("Please input the folder (enter 'r' to return):\n")
-                if folder_path.strip().lower() == 'r' or folder_path.strip().lower() == 'q':
-                    return 'r'
-                elif not os.path.isdir(folder_path):
-                    logged_print("Invalid folder path. Please try again.")
-                    continue
-                else:
-                    break
+        if not self.template_found:
+            logged_print(f"Template not found: {self.template_path}\nPlease check template_path in {self.config_file_path}.")
+            return 'r'
+        while not folder_path:
+            raw = logged_input("Please input the folder (enter 'r' to return):\n").strip()
+            cmd = raw.lower()
+            if cmd in QUIT:
+                return 'r'
+            elif not os.path.isdir(raw):
+                logged_print("Invalid folder path. Please try again.")
+            else:
+                folder_path = raw
         
         default_x_range = self.config.get("default_x_range", [0, 3.3])
         while True:
             x_range = logged_input(f"Please input the x range of DOS spectrum in the format 'start,end' (default is {default_x_range[0]},{default_x_range[1]}):\n").strip()
-            if x_range.strip().lower() == 'q' or x_range.strip().lower() == 'r':
+            cmd = x_range.lower()
+            if cmd in QUIT:
                 print("Return to last menu!")
                 return
             elif not x_range:
@@ -242,38 +323,50 @@ class AutoDOS():
         logged_print("Start plotting, please wait...\n")
 
         start_time = time.time()
-        for root, dirs, files in os.walk(folder_path):
-            for dir_name in dirs:
-                sub_folder_path = os.path.join(root, dir_name)
-                curve_file = None
-                line_file = None
-                for file in os.listdir(sub_folder_path):
-                    if file.endswith("_curve.txt"):
-                        curve_file = os.path.join(sub_folder_path, file)
-                    elif file.endswith("_line.txt"):
-                        line_file = os.path.join(sub_folder_path, file)
-                if curve_file and line_file:
-                    self.process_file(curve_file, line_file, xlim_values=xlim_values, exit_origin=False)
-        op.exit()
+        # All the pairs are found first, so the number of plots is known before Origin starts
+        pairs = list(self._find_pairs(folder_path))
+        logged_print(f"Found {len(pairs)} plot jobs")
+        if pairs:
+            # The config is read once for the whole batch
+            ylim_values = self.config.get("default_y_range", [0, 6.5])
+            template_path = self.template_path
+            show_graph = self.config.get("show_graph", False)
+            # The plots are independent, every worker process drives its own Origin instance
+            try:
+                max_instances = max(1, int(self.config.get("max_origin_instances", 2)))
+            except (TypeError, ValueError):
+                max_instances = 2
+            workers = min(len(pairs), max_instances, os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=workers, initializer=self._init_plot_worker, initargs=(show_graph,)) as executor:
+                curve_files, line_files = zip(*pairs)
+                plot = functools.partial(self.process_file, xlim_values=xlim_values, ylim_values=ylim_values, template_path=template_path,
+                                         show_graph=show_graph, exit_origin=False, fresh_session=False)
+                # Results come back in order, one line per finished plot
+                for i, _ in enumerate(executor.map(plot, curve_files, line_files), 1):
+                    logged_print(f"[{i}/{len(pairs)}] {curve_files[i - 1]}")
         end_time = time.time()
         run_time = end_time - start_time
         logged_print(f'Successfully completed! Total execution time: {run_time} seconds')
         
+    @staticmethod
+    def _init_plot_worker(show_graph):
+        # One Origin session per worker process, shared by all its plots and exited when the worker ends
+        import originpro as op
+        op.new()
+        op.set_show(show_graph)
+        multiprocessing.util.Finalize(None, op.exit, exitpriority=10)
+
     def run(self):
         start_time = datetime.now()
         logging.info(f"Func 5 started at {start_time}.strftime('%Y-%m-%d %H:%M:%S')")
         
+        # Batch plotting is the default, process_file asks for its files itself
+        handlers = {'1': self.process_folder, '': self.process_folder, '2': self.process_file}
         while True:
             choice = logged_input("\nChoose an option:\n1. Batch plot DOS\n2. Plot single DOS\n")
-            if choice == '1' or choice == '':
-                # Assuming folder_path is defined or obtained elsewhere in your code
-                result = self.process_folder()  # Call with required argument
-                if result == 'r':
-                    return
-            elif choice == '2':
-                # Call process_file without any arguments, using its default values
-                result = self.process_file()
-                if result == 'r':
+            handler = handlers.get(choice)
+            if handler:
+                if handler() == 'r':
                     return
             elif choice.strip().lower() == "q":
                 logged_print("\nReturn to the main menu!\n")